@@ -1,11 +1,21 @@
 import re
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import cv2
 import fitz  # PyMuPDF
 import numpy as np
 from fastapi import UploadFile
 
+_YEAR = re.compile(r"(19|20)\d{2}")
+
+# Documents with more text than this are treated as text documents (OTHER)
+_TEXT_THRESHOLD = 300
+
+# is_id_card works on a copy no larger than this. Its Hough parameters are in
+# absolute pixels and were tuned at this size; at 600px the rotated sample ID
+# card drops below the 4-line threshold
+_ID_CARD_MAX_DIM = 800
+
 
 class AdvancedDocumentClassifier:
     
@@ -17,62 +27,81 @@ class AdvancedDocumentClassifier:
             "DEPARTMENT OF THE TREASURY", "FORM 1098"
         ]
 
-    async def extract_text_from_pdf(self, file_content: bytes) -> str:
+    def _open(self, content: bytes) -> fitz.Document:
+        return fitz.open(stream=content, filetype="pdf")
+
+    def extract_text_from_pdf(self, doc: fitz.Document) -> str:
         
-        try:
-            doc = fitz.open(stream=file_content, filetype="pdf")
-            full_text = "\n".join([page.get_text() for page in doc]) # type: ignore
-            
-            # Print a sample of the extracted text for debugging
-            if full_text:
-                sample = full_text[:100].replace('\n', ' ')
-                #print(f"Text extraction sample: {sample}...")
-            else:
-                print("No text extracted from document")
-                
-            return full_text
-        except Exception as e:
-            print(f"Text extraction error: {e}")
-            return ""
+        # classify_document only needs to know whether there are more than
+        # _TEXT_THRESHOLD chars, so stop at the first page that gets there;
+        # for text documents that is usually page 0
+        full_text = ""
+        for page_number, page in enumerate(doc):
+            if page_number:
+                full_text += "\n"
+            full_text += page.get_text() # type: ignore
+            if len(full_text.strip()) > _TEXT_THRESHOLD:
+                break
+        
+        # Print a sample of the extracted text for debugging
+        if full_text:
+            sample = full_text[:100].replace('\n', ' ')
+            #print(f"Text extraction sample: {sample}...")
+        else:
+            print("No text extracted from document")
+            
+        return full_text
 
-    def extract_images_from_pdf(self, file_content: bytes) -> List[np.ndarray]:
+    def extract_images_from_pdf(self, doc: fitz.Document, max_pages: Optional[int] = None,
+                                zoom: float = 2.0) -> List[np.ndarray]:
         images = []
-        try:
-            doc = fitz.open(stream=file_content, filetype="pdf")
-            for page in doc:
-                pix = page.get_pixmap(matrix=fitz.Matrix(2, 2)) # type: ignore
-                img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
-                if pix.n == 4:
-                    img = cv2.cvtColor(img, cv2.COLOR_RGBA2RGB)
-                images.append(img)
-        except Exception as e:
-            print(f"Image extraction error: {e}")
+        for page in doc:
+            if max_pages is not None and len(images) >= max_pages:
+                break
+            # The CV heuristics only look at intensity, so render straight to grayscale
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False) # type: ignore
+            gray = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
+            images.append(gray)
         return images
     
-    def is_id_card(self, image: np.ndarray) -> Tuple[bool, float]:
+    def is_id_card(self, gray: np.ndarray) -> Tuple[bool, float]:
     
         try:
             # Get image dimensions and check aspect ratio
-            h, w = image.shape[:2]
+            h, w = gray.shape[:2]
             aspect_ratio = w / h
             
             # Most ID cards have aspect ratios
             aspect_score = 1.4 <= aspect_ratio <= 1.9
             #print(f"ID card aspect ratio: {aspect_ratio:.2f}, within range: {aspect_score}")
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
+            
+            # Averaging pixels lowers their spread (about 20% on a text page), so
+            # take pixel_std at full resolution before downsampling
+            _, std = cv2.meanStdDev(gray)
+            pixel_std = float(std[0, 0])
+            
+            # Compute the remaining features on a downsampled copy. INTER_AREA keeps
+            # block means, so the grid is unaffected, but HoughLinesP's threshold=80
+            # and maxLineGap=20 are absolute pixel counts tuned at _ID_CARD_MAX_DIM,
+            # so changing the cap changes which lines are found
+            if max(h, w) > _ID_CARD_MAX_DIM:
+                scale = _ID_CARD_MAX_DIM / max(h, w)
+                gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                h, w = gray.shape[:2]
+            
+            # The integral image gives any block sum from four corners. int32 is safe
+            # because the image is at most _ID_CARD_MAX_DIM square (< 2**31 / 255 pixels).
+            sums = cv2.integral(gray, sdepth=cv2.CV_32S)
             
             # Divide the image into a 3x3 grid
             h_step = h // 3
             w_step = w // 3
-            regions = []
-            
-            for i in range(3):
-                for j in range(3):
-                    region = gray[i*h_step:(i+1)*h_step, j*w_step:(j+1)*w_step]
-                    regions.append(np.mean(region)) # type: ignore
+            corners = sums[np.ix_(np.arange(4) * h_step, np.arange(4) * w_step)]
+            regions = (corners[1:, 1:] - corners[:-1, 1:]
+                       - corners[1:, :-1] + corners[:-1, :-1]) / (h_step * w_step)
              
             # different areas like photo, text, etc.
-            region_variance = np.var(regions)
+            region_variance = regions.var()
             distinct_regions = region_variance > 300
             
             #edge detection
@@ -82,7 +111,6 @@ class AdvancedDocumentClassifier:
             #detect straight lines
             lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=80, minLineLength=w/4, maxLineGap=20)
             has_straight_lines = lines is not None and len(lines) >= 4
-            pixel_std = np.std(gray) # type: ignore
             structured_layout = pixel_std < 70 
             features = [aspect_score, distinct_regions, has_straight_lines, structured_layout]
             id_card_score = sum(1 for feature in features if feature)
@@ -98,16 +126,16 @@ class AdvancedDocumentClassifier:
             #print(f"ID card detection error: {e}")
             return False, 0.0
     
-    def is_handwritten(self, image: np.ndarray) -> Tuple[bool, float]:
+    def is_handwritten(self, gray: np.ndarray) -> Tuple[bool, float]:
        
         try:
-            #to grayscale
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image
-            
             thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
                                           cv2.THRESH_BINARY_INV, 11, 2)
             
             #contours
+            # Kept over connectedComponentsWithStats: RETR_EXTERNAL folds everything inside a
+            # border into one contour (which is what keeps ID cards out), and the angle
+            # feature needs the contour points for minAreaRect
             contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
             
             
@@ -115,50 +143,53 @@ class AdvancedDocumentClassifier:
                 
                 return False, 0.0
             
-            areas = [cv2.contourArea(c) for c in contours if cv2.contourArea(c) > 10]
-            if not areas:
-                return False, 0.0
-                
-            
-            area_variation = np.std(areas) / (np.mean(areas) + 1e-5)
-            high_variation = area_variation > 2.0
-            
-            
-            
-            #bounding boxes 
-            angles = []
+            # One pass over the contours collects area, angle and y-centre of every
+            # contour with area >= 10 into preallocated arrays. The bounding box
+            # centre stands in for the moment centroid, which is much costlier.
+            n = len(contours)
+            areas = np.empty(n)
+            angles = np.empty(n)
+            y_centers = np.empty(n)
+            k = 0
             for contour in contours:
-                if cv2.contourArea(contour) < 10:
+                area = cv2.contourArea(contour)
+                if area < 10:
                     continue
+                areas[k] = area
                     
+                #bounding boxes 
                 rect = cv2.minAreaRect(contour)
                 
                 angle = abs(rect[2]) % 90
                 if angle > 45:
                     angle = 90 - angle
-                angles.append(angle)
+                angles[k] = angle
+                
+                _, y, _, box_h = cv2.boundingRect(contour)
+                y_centers[k] = y + box_h * 0.5
+                k += 1
             
-            if not angles:
+            areas = areas[:k]
+            areas = areas[areas > 10]
+            if not areas.size:
                 return False, 0.0
                 
             
-            angle_variation = np.std(angles)
-            irregular_angles = angle_variation > 10
-            
-            
+            area_variation = np.std(areas) / (np.mean(areas) + 1e-5)
+            high_variation = area_variation > 2.0
             
-            y_centers = []
-            for contour in contours:
-                if cv2.contourArea(contour) < 10:
-                    continue
-                M = cv2.moments(contour)
-                if M["m00"] != 0:
-                    y_centers.append(int(M["m01"] / M["m00"]))
             
-            if not y_centers:
+            angles = angles[:k]
+            if not angles.size:
                 return False, 0.0
                 
             
+            angle_variation = np.std(angles)
+            irregular_angles = angle_variation > 10
+            
+            
+            y_centers = y_centers[:k]
+            
             alignment_variation = np.std(y_centers) / gray.shape[0] 
             poor_alignment = alignment_variation > 0.08
             #print(f"Alignment variation: {alignment_variation:.2f}, poor alignment: {poor_alignment}")
@@ -187,7 +218,7 @@ class AdvancedDocumentClassifier:
         """Extract year from document text."""
         try:
             #regex pattern
-            match = re.search(r"(19|20)\d{2}", text)
+            match = _YEAR.search(text)
             if match:
                 return match.group(0)
             return "NOT IMPLEMENTED"
@@ -196,23 +227,36 @@ class AdvancedDocumentClassifier:
             return "NOT IMPLEMENTED"
 
     async def classify_document(self, file: UploadFile) -> Dict[str, Any]:
+        
+        try:
+            return await self.classify_bytes(await file.read())
+        except Exception as e:
+            print(f"Document classification error: {e}")
+            return {"document_type": "OTHER", "year": "NOT IMPLEMENTED"}
+
+    async def classify_bytes(self, content: bytes) -> Dict[str, Any]:
+        
+        return self.classify_content(content)
+
+    def classify_content(self, content: bytes) -> Dict[str, Any]:
+        """Synchronous pipeline, usable directly from a worker process."""
     
+        # Parse the PDF once and share it between text and image extraction
+        doc = self._open(content)
         try:
-            # Read file content
-            content = await file.read()
-            
             # Extract text and check length
-            text = await self.extract_text_from_pdf(content)
+            text = self.extract_text_from_pdf(doc)
             text_length = len(text.strip())
             #print(f"Extracted text length: {text_length} chars")
             
             
-            if text_length > 300:
+            if text_length > _TEXT_THRESHOLD:
                 #print("Document has significant text content - classifying as OTHER (tax form)")
                 return {"document_type": "OTHER", "year": self.extract_year(text)}
             
            
-            images = self.extract_images_from_pdf(content)
+            # Only the first page is analysed, so don't rasterize the rest
+            images = self.extract_images_from_pdf(doc, max_pages=1)
             #print(f"Extracted {len(images)} images for visual analysis")
             
             if images:
@@ -256,6 +300,5 @@ class AdvancedDocumentClassifier:
             #print("Classification uncertain - defaulting to OTHER")
             return {"document_type": "OTHER", "year": self.extract_year(text)}
             
-        except Exception as e:
-            #print(f"Document classification error: {e}")
-            return {"document_type": "OTHER", "year": "NOT IMPLEMENTED"}
\ No newline at end of file
+        finally:
+            doc.close()
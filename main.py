@@ -1,16 +1,83 @@
-from typing import Optional
+import asyncio
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from hashlib import blake2b
+from typing import Any, Dict, Optional
 
 from fastapi import FastAPI, File, HTTPException, UploadFile
 
 from advanced_document_classifier import AdvancedDocumentClassifier
 from initial_document_classifier import InitialDocumentClassifier
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Stop the worker processes along with the app
+    _shutdown_advanced_pool()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 initial_classifier = InitialDocumentClassifier()
 advanced_classifier = AdvancedDocumentClassifier()
 
+# Results keyed by a hash of the uploaded bytes, so repeated uploads skip the pipeline
+_RESULT_CACHE_SIZE = 512
+_result_cache: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+
+# The advanced classifier is CPU-bound (OpenCV plus Python loops over contours), so it
+# runs in worker processes to keep the event loop free and use every core. The pool
+# is created inside a request, and forking the multi-threaded server process can
+# deadlock the child, so workers are spawned instead.
+_advanced_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_advanced_pool() -> ProcessPoolExecutor:
+    """Create the advanced classifier pool on first use."""
+    global _advanced_pool
+    if _advanced_pool is None:
+        _advanced_pool = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                             mp_context=multiprocessing.get_context("spawn"))
+    return _advanced_pool
+
+
+def _shutdown_advanced_pool(pool: Optional[ProcessPoolExecutor] = None) -> None:
+    """Shut the advanced classifier pool down; the next request starts a new one.
+    
+    When pool is given, only shut down if it is still the current pool, so a late
+    caller cannot stop a replacement that another request already started.
+    """
+    global _advanced_pool
+    if _advanced_pool is not None and (pool is None or pool is _advanced_pool):
+        _advanced_pool.shutdown(wait=False, cancel_futures=True)
+        _advanced_pool = None
+
+
+def _run_advanced(content: bytes) -> Dict[str, Any]:
+    """Run the advanced classifier inside a pool worker."""
+    return advanced_classifier.classify_content(content)
+
+
+async def _classify_advanced(content: bytes) -> Dict[str, Any]:
+    """Run the advanced classifier in the pool, or in-process if the pool broke."""
+    loop = asyncio.get_running_loop()
+    pool = _get_advanced_pool()
+    try:
+        return await loop.run_in_executor(pool, _run_advanced, content)
+    except BrokenProcessPool:
+        # A worker died (crash or OOM kill); replace the pool for later
+        # requests and classify this document in-process
+        print("Advanced classifier pool broke, classifying in-process")
+        _shutdown_advanced_pool(pool)
+        return advanced_classifier.classify_content(content)
+
+
 @app.post("/classify")
 async def schedule_classify_task(file: Optional[UploadFile] = File(None)):
     """Endpoint to classify a document into "w2", "1040", "1099", etc"""
@@ -18,38 +85,49 @@ async def schedule_classify_task(file: Optional[UploadFile] = File(None)):
     if not file:
         raise HTTPException(status_code=400, detail="No file uploaded")
     
-    # Check if file is a PDF
-    if not file.content_type or not file.content_type.lower() != 'application/pdf':
-        # Read the file content for classification
-        file_copy = await file.read()
-        await file.seek(0)
+    # Read the upload once; both classifiers work on these bytes
+    content = await file.read()
+    key = blake2b(content, digest_size=16).digest()
+    cached = _result_cache.get(key)
+    if cached is not None:
+        _result_cache.move_to_end(key)
+        return dict(cached)
+    
+    # classify_bytes and classify_content raise when they cannot read the file.
+    # The request still gets the OTHER fallback, but it is not cached, since a
+    # retry may succeed.
+    document_type = "OTHER"
+    year = "NOT IMPLEMENTED"
+    failed = False
     
     try:
         # First try the initial document classifier for tax forms
-        result = await initial_classifier.classify_document(file)
+        result = await initial_classifier.classify_bytes(content)
         document_type = result.get("document_type", "OTHER")
         year = result.get("year", "NOT IMPLEMENTED")
+    except Exception as e:
+        print(f"Error classifying document: {str(e)}")
+        failed = True
+    
+    # If the initial classifier couldn't determine the type, try the advanced classifier
+    if document_type == "OTHER":
+        print("Fixed classifier returned OTHER, trying advanced classifier")
         
-        # If the initial classifier couldn't determine the type, try the advanced classifier
-        if document_type == "OTHER":
-            print("Fixed classifier returned OTHER, trying advanced classifier")
-            
-            await file.seek(0)
-            
-            # Using the advanced classifier for ID cards and handwritten notes
-            advanced_result = await advanced_classifier.classify_document(file)
+        # Using the advanced classifier for ID cards and handwritten notes
+        try:
+            advanced_result = await _classify_advanced(content)
             document_type = advanced_result.get("document_type")
             
-            # If found a specific document type, use the advanced classifier's result
+            # If it still found nothing specific, take the advanced classifier's year
             if document_type == "OTHER":
-                print("Fixed classifier returned OTHER, trying advanced classifier")
-                await file.seek(0)
-                advanced_result = await advanced_classifier.classify_document(file)
-                document_type = advanced_result.get("document_type")
                 year = advanced_result.get("year", year)
-
-        return {"document_type": document_type, "year": year}
-
-    except Exception as e:
-        print(f"Error classifying document: {str(e)}")
-        return {"document_type": "OTHER", "year": "NOT IMPLEMENTED"}
\ No newline at end of file
+        except Exception as e:
+            print(f"Error classifying document: {str(e)}")
+            failed = True
+    
+    result = {"document_type": document_type, "year": year}
+    if not failed:
+        _result_cache[key] = result
+        if len(_result_cache) > _RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+    return dict(result)